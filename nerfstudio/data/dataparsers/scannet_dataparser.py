@@ -14,19 +14,130 @@
 
 """Data parser for ScanNet dataset"""
 
+import hashlib
 import math
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Literal, Type
+from typing import Dict, List, Literal, Type
 
-import cv2
 import numpy as np
 import torch
+from PIL import Image
 
 from nerfstudio.cameras import camera_utils
 from nerfstudio.cameras.cameras import Cameras, CameraType
 from nerfstudio.data.dataparsers.base_dataparser import DataParser, DataParserConfig, DataparserOutputs
 from nerfstudio.data.scene_box import SceneBox
+from nerfstudio.utils.rich_utils import CONSOLE
+
+
+def _sorted_numeric(directory: Path) -> List[Path]:
+    """Lists the files of a directory ordered by the frame index their names start with (e.g. 0.jpg, 1.jpg, 10.jpg)."""
+    paths = list(directory.iterdir())
+    frame_ids = np.fromiter((int(path.name.split(".")[0]) for path in paths), dtype=np.int64, count=len(paths))
+    return [paths[i] for i in np.argsort(frame_ids, kind="stable")]
+
+
+# Bump whenever the content of the scene cache changes, so that older cache files are not reused.
+_SCENE_CACHE_VERSION = 2
+_SCENE_KEYS = frozenset(
+    (
+        "fingerprint",
+        "image_filenames",
+        "depth_filenames",
+        "image_size",
+        "intrinsics",
+        "poses",
+        "transform_matrix",
+        "scale_factor",
+    )
+)
+
+# Number of .ply points transformed at once, which bounds the memory used on top of the output.
+_POINTS_CHUNK_SIZE = 1_000_000
+
+_PLY_PROPERTY_DTYPES = {
+    "char": "i1",
+    "int8": "i1",
+    "uchar": "u1",
+    "uint8": "u1",
+    "short": "i2",
+    "int16": "i2",
+    "ushort": "u2",
+    "uint16": "u2",
+    "int": "i4",
+    "int32": "i4",
+    "uint": "u4",
+    "uint32": "u4",
+    "float": "f4",
+    "float32": "f4",
+    "double": "f8",
+    "float64": "f8",
+}
+
+
+def _read_ply_vertices(ply_file_path: Path) -> np.ndarray:
+    """Reads the vertex element of a .ply file as a structured numpy array.
+
+    Binary files are memory-mapped, so vertices are only read from disk once they are accessed.
+
+    Args:
+        ply_file_path: Path to .ply file
+
+    Returns:
+        The vertices, with one field per vertex property.
+    """
+    with open(ply_file_path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{ply_file_path} is not a .ply file")
+        ply_format, element, num_vertices, properties = None, None, 0, []
+        num_header_lines = 1
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{ply_file_path} has no end_header line")
+            num_header_lines += 1
+            tokens = line.decode("ascii").split()
+            if not tokens:
+                continue
+            if tokens[0] == "format":
+                ply_format = tokens[1]
+            elif tokens[0] == "element":
+                if element is None and tokens[1] != "vertex":
+                    raise ValueError(f"{ply_file_path} must start with its vertex element, got {tokens[1]}")
+                element = tokens[1]
+                if element == "vertex":
+                    num_vertices = int(tokens[2])
+            elif tokens[0] == "property" and element == "vertex":
+                if tokens[1] not in _PLY_PROPERTY_DTYPES:
+                    raise ValueError(f"Unsupported vertex property type {tokens[1]} in {ply_file_path}")
+                properties.append((tokens[2], _PLY_PROPERTY_DTYPES[tokens[1]]))
+            elif tokens[0] == "end_header":
+                break
+        offset = f.tell()
+
+    if ply_format == "binary_little_endian":
+        byte_order = "<"
+    elif ply_format == "binary_big_endian":
+        byte_order = ">"
+    elif ply_format == "ascii":
+        byte_order = "="
+    else:
+        raise ValueError(f"Unknown .ply format {ply_format} in {ply_file_path}")
+    dtype = np.dtype([(name, byte_order + prop_dtype) for name, prop_dtype in properties])
+    names = dtype.names or ()
+    missing_axes = [axis for axis in ("x", "y", "z") if axis not in names]
+    if missing_axes:
+        raise ValueError(f"The vertex element of {ply_file_path} has no {', '.join(missing_axes)} properties")
+    if num_vertices == 0:
+        return np.empty(0, dtype=dtype)
+    if ply_format == "ascii":
+        return np.loadtxt(ply_file_path, dtype=dtype, skiprows=num_header_lines, max_rows=num_vertices, ndmin=1)
+    return np.memmap(ply_file_path, dtype=dtype, mode="r", offset=offset, shape=(num_vertices,))
 
 
 @dataclass
@@ -68,6 +179,8 @@ class ScanNetDataParserConfig(DataParserConfig):
     """read point cloud colors from .ply files or not """
     ply_file_path: Path = data / (data.name + ".ply")
     """path to the .ply file containing the 3D points"""
+    cache_scene: bool = True
+    """Whether to cache the parsed poses and point cloud in the scene folder, to skip parsing them on later runs."""
 
 
 @dataclass
@@ -77,44 +190,21 @@ class ScanNet(DataParser):
     config: ScanNetDataParserConfig
 
     def _generate_dataparser_outputs(self, split="train"):
-        image_dir = self.config.data / "color"
-        depth_dir = self.config.data / "depth"
-        pose_dir = self.config.data / "pose"
-
-        img_dir_sorted = list(sorted(image_dir.iterdir(), key=lambda x: int(x.name.split(".")[0])))
-        depth_dir_sorted = list(sorted(depth_dir.iterdir(), key=lambda x: int(x.name.split(".")[0])))
-        pose_dir_sorted = list(sorted(pose_dir.iterdir(), key=lambda x: int(x.name.split(".")[0])))
-
-        first_img = cv2.imread(str(img_dir_sorted[0].absolute()))  # type: ignore
-        h, w, _ = first_img.shape
-
-        image_filenames, depth_filenames, intrinsics, poses = [], [], [], []
-
-        K = np.loadtxt(self.config.data / "intrinsic" / "intrinsic_color.txt")
-        for img, depth, pose in zip(img_dir_sorted, depth_dir_sorted, pose_dir_sorted):
-            pose = np.loadtxt(pose)
-            pose = np.array(pose).reshape(4, 4)
-            pose[:3, 1] *= -1
-            pose[:3, 2] *= -1
-            pose = torch.from_numpy(pose).float()
-            # We cannot accept files directly, as some of the poses are invalid
-            if np.isinf(pose).any():
-                continue
-
-            poses.append(pose)
-            intrinsics.append(K)
-            image_filenames.append(img)
-            depth_filenames.append(depth)
+        scene = self._load_scene()
+        image_filenames = [self.config.data / "color" / name for name in scene["image_filenames"].tolist()]
+        depth_filenames = [self.config.data / "depth" / name for name in scene["depth_filenames"].tolist()]
+        h, w = scene["image_size"].tolist()
 
         # filter image_filenames and poses based on train/eval split percentage
         num_images = len(image_filenames)
         num_train_images = math.ceil(num_images * self.config.train_split_fraction)
         num_eval_images = num_images - num_train_images
-        i_all = np.arange(num_images)
         i_train = np.linspace(
             0, num_images - 1, num_train_images, dtype=int
         )  # equally spaced training images starting and ending at 0 and num_images-1
-        i_eval = np.setdiff1d(i_all, i_train)  # eval images are the remaining images
+        eval_mask = np.ones(num_images, dtype=bool)
+        eval_mask[i_train] = False
+        i_eval = np.nonzero(eval_mask)[0]  # eval images are the remaining images
         assert len(i_eval) == num_eval_images
         if split == "train":
             indices = i_train
@@ -123,28 +213,15 @@ class ScanNet(DataParser):
         else:
             raise ValueError(f"Unknown dataparser split {split}")
 
-        poses = torch.from_numpy(np.stack(poses).astype(np.float32))
-        intrinsics = torch.from_numpy(np.stack(intrinsics).astype(np.float32))
-
-        poses, transform_matrix = camera_utils.auto_orient_and_center_poses(
-            poses,
-            method="none",
-            center_method=self.config.center_method,
-        )
-
-        # Scale poses
-        scale_factor = 1.0
-        if self.config.auto_scale_poses:
-            scale_factor /= float(torch.max(torch.abs(poses[:, :3, 3])))
-        scale_factor *= self.config.scale_factor
-
-        poses[:, :3, 3] *= scale_factor
+        poses = torch.from_numpy(scene["poses"])
+        K = scene["intrinsics"]
+        transform_matrix = torch.from_numpy(scene["transform_matrix"])
+        scale_factor = float(scene["scale_factor"])
 
         # Choose image_filenames and poses based on split, but after auto orient and scaling the poses.
         image_filenames = [image_filenames[i] for i in indices]
         depth_filenames = [depth_filenames[i] for i in indices] if len(depth_filenames) > 0 else []
-        intrinsics = intrinsics[indices.tolist()]
-        poses = poses[indices.tolist()]
+        poses = poses.index_select(0, torch.from_numpy(indices))
 
         # in x,y,z order
         # assumes that the scene is centered at the origin
@@ -155,11 +232,12 @@ class ScanNet(DataParser):
             )
         )
 
+        # All frames share the same intrinsics, which Cameras broadcasts over the batch.
         cameras = Cameras(
-            fx=intrinsics[:, 0, 0],
-            fy=intrinsics[:, 1, 1],
-            cx=intrinsics[:, 0, 2],
-            cy=intrinsics[:, 1, 2],
+            fx=float(K[0, 0]),
+            fy=float(K[1, 1]),
+            cx=float(K[0, 2]),
+            cy=float(K[1, 2]),
             height=h,
             width=w,
             camera_to_worlds=poses[:, :3, :4],
@@ -171,12 +249,10 @@ class ScanNet(DataParser):
             "depth_unit_scale_factor": self.config.depth_unit_scale_factor,
         }
 
-        if self.config.load_3D_points:
-            point_color = self.config.point_cloud_color
-            ply_file_path = self.config.ply_file_path
-            point_cloud_data = self._load_3D_points(ply_file_path, transform_matrix, scale_factor, point_color)
-            if point_cloud_data is not None:
-                metadata.update(point_cloud_data)
+        for key in ("points3D_xyz", "points3D_rgb"):
+            if key in scene:
+                # C-contiguous buffers keep later host to device copies on the fast path.
+                metadata[key] = torch.from_numpy(np.ascontiguousarray(scene[key]))
 
         dataparser_outputs = DataparserOutputs(
             image_filenames=image_filenames,
@@ -188,6 +264,151 @@ class ScanNet(DataParser):
         )
         return dataparser_outputs
 
+    def _scene_cache_path(self) -> Path:
+        """Returns the cache file of the scene, named after the config fields that affect the parsed scene."""
+        key = (
+            _SCENE_CACHE_VERSION,
+            self.config.scale_factor,
+            self.config.center_method,
+            self.config.auto_scale_poses,
+            self.config.load_3D_points,
+            self.config.point_cloud_color,
+            self.config.ply_file_path.name if self.config.load_3D_points else None,
+        )
+        cache_key = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+        return self.config.data / f".nerfstudio_cache_{cache_key}.npz"
+
+    def _scene_fingerprint(self) -> str:
+        """Returns a hash of the modification times of the scene inputs, stored in the cache to detect stale files."""
+        data = self.config.data
+        inputs = [data / "color", data / "depth", data / "pose", data / "intrinsic" / "intrinsic_color.txt"]
+        if self.config.load_3D_points and self.config.ply_file_path.exists():
+            inputs.append(self.config.ply_file_path)
+        # Directory mtimes only change when files are added or removed, so also track pose files edited in place.
+        pose_mtimes = sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(data / "pose"))
+        key = ([(str(path.absolute()), path.stat().st_mtime_ns) for path in inputs], pose_mtimes)
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    def _load_scene(self) -> Dict[str, np.ndarray]:
+        """Returns the split independent scene data, reading it from the on-disk cache when it is up to date.
+
+        There is one cache file per parsing config, which is overwritten whenever the scene inputs change.
+        """
+        if not self.config.cache_scene:
+            return self._parse_scene()
+
+        cache_file = self._scene_cache_path()
+        fingerprint = self._scene_fingerprint()
+        if cache_file.exists():
+            try:
+                with np.load(cache_file) as cached:
+                    scene = dict(cached)
+                missing_keys = _SCENE_KEYS.difference(scene)
+                if missing_keys:
+                    raise KeyError(f"missing {sorted(missing_keys)}")
+                if str(scene.pop("fingerprint")) == fingerprint:
+                    return scene
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                CONSOLE.print(f"[yellow]Ignoring unreadable scene cache {cache_file}: {e}")
+
+        scene = self._parse_scene()
+        # Write to a unique temporary file first, so that concurrent runs never see or publish a partial cache.
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=self.config.data, prefix=".nerfstudio_tmp_", suffix=".npz")
+        except OSError as e:
+            CONSOLE.print(f"[yellow]Could not write the scene cache {cache_file}: {e}")
+            return scene
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, fingerprint=np.array(fingerprint), **scene)  # pyright: ignore[reportArgumentType]
+            # mkstemp creates the file as 0600, give it the permissions of a regular file so it can be shared.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+            os.replace(tmp_name, cache_file)
+        except OSError as e:
+            CONSOLE.print(f"[yellow]Could not write the scene cache {cache_file}: {e}")
+            Path(tmp_name).unlink(missing_ok=True)
+        return scene
+
+    def _parse_scene(self) -> Dict[str, np.ndarray]:
+        """Parses the frames, poses, intrinsics and point cloud of the scene, none of which depend on the split.
+
+        Returns:
+            A dictionary of numpy arrays, so that it can be stored as is in a .npz cache.
+        """
+        image_dir = self.config.data / "color"
+        depth_dir = self.config.data / "depth"
+        pose_dir = self.config.data / "pose"
+
+        img_dir_sorted = _sorted_numeric(image_dir)
+        depth_dir_sorted = _sorted_numeric(depth_dir)
+        pose_dir_sorted = _sorted_numeric(pose_dir)
+
+        # PIL only parses the header here, so the first frame is never fully decoded.
+        with Image.open(img_dir_sorted[0]) as first_img:
+            w, h = first_img.size
+
+        K = np.loadtxt(self.config.data / "intrinsic" / "intrinsic_color.txt")
+
+        # Read the (many, small) pose files concurrently, then parse them in a single vectorized call.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pose_bytes = list(executor.map(Path.read_bytes, pose_dir_sorted))
+        poses_np = np.fromstring(b"\n".join(pose_bytes), dtype=np.float32, sep=" ")
+        num_frames = len(pose_dir_sorted)
+        if poses_np.size != num_frames * 16:
+            raise ValueError(f"Expected {num_frames} 4x4 poses in {pose_dir}, but parsed {poses_np.size} values")
+        if not len(img_dir_sorted) == len(depth_dir_sorted) == num_frames:
+            raise ValueError(
+                f"Expected as many color, depth and pose files in {self.config.data}, "
+                f"got {len(img_dir_sorted)}, {len(depth_dir_sorted)} and {num_frames}"
+            )
+        poses_np = poses_np.reshape(num_frames, 4, 4)
+        # We cannot accept files directly, as some of the poses are invalid
+        valid = ~np.isinf(poses_np).reshape(len(poses_np), -1).any(axis=1)
+        if not valid.all():
+            poses_np = poses_np[valid]
+        # Flip the y and z camera axes of every kept pose in one in-place multiply.
+        poses_np[:, :3, 1:3] *= -1
+
+        image_filenames = np.asarray([path.name for path in img_dir_sorted])[valid]
+        depth_filenames = np.asarray([path.name for path in depth_dir_sorted])[valid]
+
+        poses, transform_matrix = camera_utils.auto_orient_and_center_poses(
+            torch.from_numpy(poses_np),
+            method="none",
+            center_method=self.config.center_method,
+        )
+
+        # Scale poses
+        scale_factor = 1.0
+        if self.config.auto_scale_poses:
+            scale_factor /= float(poses[:, :3, 3].abs().amax().clamp_min_(1e-12))
+        scale_factor *= self.config.scale_factor
+
+        poses[:, :3, 3] *= scale_factor
+
+        scene = {
+            "image_filenames": image_filenames,
+            "depth_filenames": depth_filenames,
+            "image_size": np.array([h, w]),
+            "intrinsics": K.astype(np.float32),
+            "poses": poses.numpy(),
+            "transform_matrix": transform_matrix.numpy(),
+            "scale_factor": np.array(scale_factor),
+        }
+
+        if self.config.load_3D_points:
+            ply_file_path = self.config.ply_file_path
+            if ply_file_path.exists():
+                point_color = self.config.point_cloud_color
+                point_cloud_data = self._load_3D_points(ply_file_path, transform_matrix, scale_factor, point_color)
+                scene.update({key: value.numpy() for key, value in point_cloud_data.items()})
+            else:
+                CONSOLE.print(f"[yellow]load_3D_points is true, but {ply_file_path} does not exist. Skipping it.")
+
+        return scene
+
     def _load_3D_points(
         self, ply_file_path: Path, transform_matrix: torch.Tensor, scale_factor: float, points_color: bool
     ) -> dict:
@@ -204,32 +425,40 @@ class ScanNet(DataParser):
             or
             A dictionary of points: points3D_xyz if points_color is False
         """
-        import open3d as o3d  # Importing open3d is slow, so we only do it if we need it.
-
-        pcd = o3d.io.read_point_cloud(str(ply_file_path))
+        vertices = _read_ply_vertices(ply_file_path)
+        names = vertices.dtype.names or ()
+        colors = None
+        if points_color and {"red", "green", "blue"}.issubset(names):
+            colors = np.stack([vertices["red"], vertices["green"], vertices["blue"]], axis=-1)
+            if np.issubdtype(colors.dtype, np.floating):
+                # Scale and cast to uint8 in one pass, without another float intermediate.
+                colors_u8 = np.empty(colors.shape, dtype=np.uint8)
+                np.multiply(colors, 255.0, out=colors_u8, casting="unsafe")
+                colors = colors_u8
+            elif colors.dtype != np.uint8:
+                # Wider integer colors span the range of their type, round so that its maximum maps to 255.
+                colors = np.rint(colors * (255.0 / np.iinfo(colors.dtype).max)).astype(np.uint8)
 
         # if no points found don't read in an initial point cloud
-        if len(pcd.points) == 0:
+        if len(vertices) == 0:
             return {}
 
-        points3D = torch.from_numpy(np.asarray(pcd.points, dtype=np.float32))
-        points3D = (
-            torch.cat(
-                (
-                    points3D,
-                    torch.ones_like(points3D[..., :1]),
-                ),
-                -1,
-            )
-            @ transform_matrix.T
-        )
-        points3D *= scale_factor
+        # Apply rotation and translation in one fused GEMM instead of padding to homogeneous coordinates.
+        # Points are transformed in chunks, so that only one chunk of the (memory-mapped) input is read at a time.
+        rotation = transform_matrix[:3, :3].T.contiguous()
+        translation = transform_matrix[:3, 3]
+        points3D = torch.empty((len(vertices), 3), dtype=torch.float32)
+        for start in range(0, len(vertices), _POINTS_CHUNK_SIZE):
+            end = start + _POINTS_CHUNK_SIZE
+            xyz = np.stack([vertices[axis][start:end] for axis in ("x", "y", "z")], axis=-1)
+            chunk = torch.from_numpy(np.ascontiguousarray(xyz, dtype=np.float32))
+            torch.addmm(translation, chunk, rotation, out=points3D[start:end])
+        points3D.mul_(scale_factor)
         out = {
             "points3D_xyz": points3D,
         }
 
-        if points_color:
-            points3D_rgb = torch.from_numpy((np.asarray(pcd.colors) * 255).astype(np.uint8))
-            out["points3D_rgb"] = points3D_rgb
+        if colors is not None:
+            out["points3D_rgb"] = torch.from_numpy(np.ascontiguousarray(colors, dtype=np.uint8))
 
         return out
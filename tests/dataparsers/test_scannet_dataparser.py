@@ -0,0 +1,289 @@
+"""
+ScanNet dataparser
+"""
+
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from pytest import fixture
+
+PLY_TYPE_NAMES = {"f4": "float", "f8": "double", "u1": "uchar", "u2": "ushort"}
+
+
+def write_ply(
+    path: Path,
+    vertices: np.ndarray,
+    *,
+    ply_format: str = "binary_little_endian",
+    comments=(),
+    header_extra=(),
+    body_extra=b"",
+):
+    """Writes a structured array of vertices to a .ply file, followed by optional extra elements"""
+    header = ["ply", f"format {ply_format} 1.0", *[f"comment {comment}" for comment in comments]]
+    header += [f"element vertex {len(vertices)}"]
+    header += [f"property {PLY_TYPE_NAMES[vertices.dtype[name].str[1:]]} {name}" for name in vertices.dtype.names]
+    header += [*header_extra, "end_header"]
+    if ply_format == "ascii":
+        body = "".join(" ".join(str(value) for value in vertex) + "\n" for vertex in vertices.tolist()).encode()
+    else:
+        byte_order = "<" if ply_format == "binary_little_endian" else ">"
+        body = vertices.astype(vertices.dtype.newbyteorder(byte_order)).tobytes()
+    path.write_bytes(("\n".join(header) + "\n").encode() + body + body_extra)
+
+
+def make_vertices(num_points: int = 4) -> np.ndarray:
+    """Vertices with distinct positions and uchar colors"""
+    dtype = [("x", "f4"), ("y", "f4"), ("z", "f4"), ("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    vertices = np.zeros(num_points, dtype=dtype)
+    for i, axis in enumerate(("x", "y", "z")):
+        vertices[axis] = np.arange(num_points) + 0.5 * i
+    for i, channel in enumerate(("red", "green", "blue")):
+        vertices[channel] = np.arange(num_points) * 10 + i
+    return vertices
+
+
+@fixture
+def mocked_scene(tmp_path: Path):
+    """Mocked ScanNet scene with color, depth, pose, intrinsic and .ply files"""
+    for name in ("color", "depth", "pose", "intrinsic"):
+        (tmp_path / name).mkdir()
+    for i in range(10):
+        Image.new("RGB", (16, 12)).save(tmp_path / "color" / f"{i}.jpg")
+        Image.new("I;16", (16, 12)).save(tmp_path / "depth" / f"{i}.png")
+        pose = np.eye(4)
+        pose[:3, 3] = [i, -i, 2 * i]
+        np.savetxt(tmp_path / "pose" / f"{i}.txt", pose)
+    np.savetxt(tmp_path / "intrinsic" / "intrinsic_color.txt", np.diag([10.0, 11.0, 1.0, 1.0]))
+    write_ply(tmp_path / "scene.ply", make_vertices())
+    return tmp_path
+
+
+def _setup_parser(data: Path):
+    from nerfstudio.data.dataparsers.scannet_dataparser import ScanNetDataParserConfig
+
+    return ScanNetDataParserConfig(data=data, ply_file_path=data / "scene.ply").setup()
+
+
+def _setup_pose_parser(data: Path, **kwargs):
+    from nerfstudio.data.dataparsers.scannet_dataparser import ScanNetDataParserConfig
+
+    return ScanNetDataParserConfig(data=data, load_3D_points=False, cache_scene=False, **kwargs).setup()
+
+
+@pytest.mark.parametrize("center_method", ["none", "poses"])
+def test_scannet_poses(mocked_scene, center_method):
+    """Tests that poses are flipped to the nerfstudio convention, centered and scaled"""
+    rotation = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    poses = np.tile(np.eye(4), (10, 1, 1))
+    poses[:, :3, :3] = rotation
+    poses[:, :3, 3] = np.arange(30).reshape(10, 3)
+    for i, pose in enumerate(poses):
+        np.savetxt(mocked_scene / "pose" / f"{i}.txt", pose)
+
+    expected = poses[:, :3, :4].copy()
+    expected[:, :, 1:3] *= -1
+    if center_method == "poses":
+        expected[:, :, 3] -= expected[:, :, 3].mean(axis=0)
+    expected[:, :, 3] /= np.abs(expected[:, :, 3]).max()
+
+    parser = _setup_pose_parser(mocked_scene, center_method=center_method, train_split_fraction=0.5)
+    for split in ("train", "val"):
+        out = parser.get_dataparser_outputs(split)
+        indices = [int(path.stem) for path in out.image_filenames]
+        assert [int(path.stem) for path in out.metadata["depth_filenames"]] == indices
+        assert torch.allclose(out.cameras.camera_to_worlds, torch.from_numpy(expected[indices]).float(), atol=1e-6)
+        assert torch.allclose(out.cameras.fx, torch.tensor(10.0))
+        assert torch.allclose(out.cameras.fy, torch.tensor(11.0))
+
+
+def test_scannet_invalid_pose_dropped(mocked_scene):
+    """Tests that an invalid pose is dropped together with its color and depth files"""
+    np.savetxt(mocked_scene / "pose" / "3.txt", np.full((4, 4), -np.inf))
+    parser = _setup_pose_parser(mocked_scene, train_split_fraction=0.5)
+
+    image_filenames, depth_filenames = [], []
+    for split in ("train", "val"):
+        out = parser.get_dataparser_outputs(split)
+        assert torch.isfinite(out.cameras.camera_to_worlds).all()
+        image_filenames += out.image_filenames
+        depth_filenames += out.metadata["depth_filenames"]
+    assert sorted(path.name for path in image_filenames) == sorted(f"{i}.jpg" for i in range(10) if i != 3)
+    assert sorted(path.name for path in depth_filenames) == sorted(f"{i}.png" for i in range(10) if i != 3)
+
+
+@pytest.mark.parametrize(
+    "broken_file, content",
+    [
+        ("color/5.jpg", None),
+        ("depth/5.png", None),
+        ("pose/5.txt", b"1 0 0 0\n0 1 0 0\n"),
+        ("pose/5.txt", b""),
+    ],
+)
+def test_scannet_mismatched_frames(mocked_scene, broken_file, content):
+    """Tests that missing frame files and truncated poses raise a ValueError"""
+    if content is None:
+        (mocked_scene / broken_file).unlink()
+    else:
+        (mocked_scene / broken_file).write_bytes(content)
+    with pytest.raises(ValueError, match="Expected"):
+        _setup_pose_parser(mocked_scene).get_dataparser_outputs("train")
+
+
+def test_scannet_scene_cache_hit(mocked_scene, monkeypatch):
+    """Tests that a second parser reads the scene from the cache"""
+    from nerfstudio.data.dataparsers.scannet_dataparser import ScanNet
+
+    expected = _setup_parser(mocked_scene).get_dataparser_outputs("train")
+    (cache_file,) = mocked_scene.glob(".nerfstudio_cache_*.npz")
+    assert len(list(mocked_scene.glob(".nerfstudio_tmp_*"))) == 0
+    umask = os.umask(0)
+    os.umask(umask)
+    assert cache_file.stat().st_mode & 0o777 == 0o666 & ~umask
+
+    def fail(self):
+        raise AssertionError("the scene should be read from the cache")
+
+    monkeypatch.setattr(ScanNet, "_parse_scene", fail)
+    cached = _setup_parser(mocked_scene).get_dataparser_outputs("train")
+    assert cached.image_filenames == expected.image_filenames
+    assert torch.allclose(cached.cameras.camera_to_worlds, expected.cameras.camera_to_worlds)
+    assert torch.equal(cached.metadata["points3D_xyz"], expected.metadata["points3D_xyz"])
+    assert torch.equal(cached.metadata["points3D_rgb"], expected.metadata["points3D_rgb"])
+
+
+def test_scannet_scene_cache_invalidated_by_pose_edit(mocked_scene, monkeypatch):
+    """Tests that editing a pose file in place invalidates the cache"""
+    from nerfstudio.data.dataparsers.scannet_dataparser import ScanNet
+
+    _setup_parser(mocked_scene).get_dataparser_outputs("train")
+
+    pose_file = mocked_scene / "pose" / "0.txt"
+    pose = np.eye(4)
+    pose[:3, 3] = [5, 5, 5]
+    np.savetxt(pose_file, pose)
+    stat = pose_file.stat()
+    os.utime(pose_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    parsed = []
+    parse_scene = ScanNet._parse_scene
+    monkeypatch.setattr(ScanNet, "_parse_scene", lambda self: parsed.append(True) or parse_scene(self))
+    _setup_parser(mocked_scene).get_dataparser_outputs("train")
+    assert parsed
+    # the stale cache file is overwritten rather than kept next to the new one
+    assert len(list(mocked_scene.glob(".nerfstudio_cache_*.npz"))) == 1
+
+
+def test_scannet_scene_cache_corrupt(mocked_scene):
+    """Tests that an unreadable cache file is re-parsed and replaced"""
+    expected = _setup_parser(mocked_scene).get_dataparser_outputs("train")
+    (cache_file,) = mocked_scene.glob(".nerfstudio_cache_*.npz")
+    cache_file.write_bytes(b"not a zip archive")
+
+    outputs = _setup_parser(mocked_scene).get_dataparser_outputs("train")
+    assert torch.allclose(outputs.cameras.camera_to_worlds, expected.cameras.camera_to_worlds)
+    with np.load(cache_file) as cached:
+        assert "poses" in cached
+
+
+def _load_points(ply_file_path: Path, transform_matrix=None, scale_factor: float = 1.0, points_color: bool = True):
+    from nerfstudio.data.dataparsers.scannet_dataparser import ScanNetDataParserConfig
+
+    if transform_matrix is None:
+        transform_matrix = torch.eye(4)[:3]
+    parser = ScanNetDataParserConfig(data=ply_file_path.parent, ply_file_path=ply_file_path).setup()
+    return parser._load_3D_points(ply_file_path, transform_matrix, scale_factor, points_color)
+
+
+def _expected_xyz(vertices: np.ndarray) -> torch.Tensor:
+    return torch.from_numpy(np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=-1).astype(np.float32))
+
+
+def _expected_rgb(vertices: np.ndarray) -> torch.Tensor:
+    return torch.from_numpy(np.stack([vertices["red"], vertices["green"], vertices["blue"]], axis=-1))
+
+
+def test_read_ply_binary_little_endian_with_faces(tmp_path):
+    """Tests a binary little-endian .ply whose vertices are followed by a face element"""
+    vertices = make_vertices()
+    write_ply(
+        tmp_path / "scene.ply",
+        vertices,
+        header_extra=("element face 1", "property list uchar int vertex_indices"),
+        body_extra=struct.pack("<Biii", 3, 0, 1, 2),
+    )
+    out = _load_points(tmp_path / "scene.ply")
+    assert torch.equal(out["points3D_xyz"], _expected_xyz(vertices))
+    assert torch.equal(out["points3D_rgb"], _expected_rgb(vertices))
+
+
+def test_read_ply_binary_big_endian(tmp_path):
+    """Tests a binary big-endian .ply"""
+    vertices = make_vertices()
+    write_ply(tmp_path / "scene.ply", vertices, ply_format="binary_big_endian")
+    out = _load_points(tmp_path / "scene.ply")
+    assert torch.equal(out["points3D_xyz"], _expected_xyz(vertices))
+    assert torch.equal(out["points3D_rgb"], _expected_rgb(vertices))
+
+
+def test_read_ply_ascii_with_comments(tmp_path):
+    """Tests an ascii .ply with comment lines in its header"""
+    vertices = make_vertices()
+    write_ply(tmp_path / "scene.ply", vertices, ply_format="ascii", comments=("made by a test", "another comment"))
+    out = _load_points(tmp_path / "scene.ply")
+    assert torch.equal(out["points3D_xyz"], _expected_xyz(vertices))
+    assert torch.equal(out["points3D_rgb"], _expected_rgb(vertices))
+
+
+def test_read_ply_without_colors(tmp_path):
+    """Tests a .ply that only has vertex positions"""
+    vertices = np.zeros(3, dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
+    vertices["x"] = [1.0, 2.0, 3.0]
+    vertices["z"] = [-1.0, 0.5, 4.0]
+    write_ply(tmp_path / "scene.ply", vertices)
+    out = _load_points(tmp_path / "scene.ply")
+    assert torch.equal(out["points3D_xyz"], _expected_xyz(vertices))
+    assert "points3D_rgb" not in out
+
+
+def test_read_ply_ushort_colors(tmp_path):
+    """Tests that ushort colors are rescaled to uint8 instead of wrapping around"""
+    dtype = [("x", "f4"), ("y", "f4"), ("z", "f4"), ("red", "u2"), ("green", "u2"), ("blue", "u2")]
+    vertices = np.zeros(2, dtype=dtype)
+    vertices["red"] = [0, 65535]
+    vertices["green"] = [65535, 0]
+    write_ply(tmp_path / "scene.ply", vertices)
+    out = _load_points(tmp_path / "scene.ply")
+    assert out["points3D_rgb"].tolist() == [[0, 255, 0], [255, 0, 0]]
+
+
+def test_read_ply_without_positions(tmp_path):
+    """Tests that a vertex element without x/y/z properties is rejected"""
+    vertices = np.zeros(2, dtype=[("red", "u1"), ("green", "u1"), ("blue", "u1")])
+    write_ply(tmp_path / "scene.ply", vertices)
+    with pytest.raises(ValueError, match="x, y, z"):
+        _load_points(tmp_path / "scene.ply")
+
+
+def test_load_points_in_chunks(tmp_path, monkeypatch):
+    """Tests that chunked transforms match a single homogeneous transform of all points"""
+    from nerfstudio.data.dataparsers import scannet_dataparser
+
+    monkeypatch.setattr(scannet_dataparser, "_POINTS_CHUNK_SIZE", 7)
+    vertices = make_vertices(23)
+    write_ply(tmp_path / "scene.ply", vertices)
+    generator = torch.Generator().manual_seed(0)
+    transform_matrix = torch.randn((3, 4), generator=generator)
+    scale_factor = 0.37
+
+    out = _load_points(tmp_path / "scene.ply", transform_matrix, scale_factor)
+    points = _expected_xyz(vertices)
+    expected = torch.cat((points, torch.ones_like(points[..., :1])), -1) @ transform_matrix.T * scale_factor
+    assert torch.allclose(out["points3D_xyz"], expected, atol=1e-5)
+    assert torch.equal(out["points3D_rgb"], _expected_rgb(vertices))